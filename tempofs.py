@@ -9,58 +9,416 @@ import os
 import stat
 import pathlib
 from argparse import ArgumentParser
+from collections import OrderedDict, deque
 from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 
+import httpx
 import pyfuse3
-import requests
 import trio
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# the values of Accept-Ranges, in lower case, which mean that seeking is unsupported
+_NONSEEKABLE_VALUES = frozenset({"none", "false", "0", "no"})
+
+
+class BlockCache:
+    """A LRU cache of aligned file blocks, bounded by the total size in bytes."""
+
+    def __init__(self, block_size=4 * 1024 * 1024, max_bytes=100 * 1024 * 1024):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def get(self, key):
+        try:
+            self.blocks.move_to_end(key)
+        except KeyError:
+            return None
+        return self.blocks[key]
+
+    def put(self, key, data):
+        if key in self.blocks:
+            self.nbytes -= len(self.blocks.pop(key))
+        self.blocks[key] = data
+        self.nbytes += len(data)
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.blocks.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def invalidate(self, inode):
+        for key in [key for key in self.blocks if key[0] == inode]:
+            self.nbytes -= len(self.blocks.pop(key))
+
+
+class PendingBlock:
+    """A block being downloaded, whose readers wait until its data has arrived."""
+
+    def __init__(self):
+        self.data = None
+        # set if the data was dropped because the file has changed meanwhile
+        self.outdated = False
+        self._event = trio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def set(self, data, outdated=False):
+        self.data = data
+        self.outdated = outdated
+        self._event.set()
+
+    async def wait(self):
+        await self._event.wait()
+        return self.data
+
 
 class webfile:
-    def __init__(self, inode, name, url) -> None:
+    def __init__(
+        self,
+        inode,
+        name,
+        url,
+        client,
+        cache,
+        prefetch_blocks=4,
+        parallel_threshold=8 * 1024 * 1024,
+        workers=8,
+    ) -> None:
         self.inode = inode
         self.name = name if name else os.path.basename(urlparse(url).path)
+        self.name_bytes = os.fsencode(self.name)
         self.url = url
-        self.session = requests.Session()
-        self.headers = self.session.head(self.url).headers
+        self.client = client
+        self.cache = cache
+        self.prefetch_blocks = prefetch_blocks
+        self.parallel_threshold = parallel_threshold
+        self.workers = workers
+        self._last_reads = deque(maxlen=4)
+        # bumped on every non-sequential read to discard outdated prefetches
+        self._generation = 0
+        # bumped whenever the file changes on the server, to discard old content
+        self._version = 0
+        self._inflight = {}
 
-    async def getattr(self) -> pyfuse3.EntryAttributes:
-        entry = pyfuse3.EntryAttributes()
-        entry.st_ino = self.inode
-        entry.st_mode = stat.S_IFREG | 0o444
-        try:
-            last_modified = (
-                parsedate_to_datetime(self.headers["Last-Modified"]).timestamp() * 1e9
-            )
-        except KeyError:
-            last_modified = 0
-        entry.st_ctime_ns = last_modified
-        entry.st_atime_ns = last_modified
-        entry.st_mtime_ns = last_modified
-        entry.st_size = int(self.headers.get("Content-Length", 0))
-        return entry
+    async def probe(self):
+        """Fetch the metadata of the file, before it is mounted."""
+        self.parse((await self.client.head(self.url)).headers)
 
-    async def getfileinfo(self) -> pyfuse3.FileInfo:
-        nonseekable = self.headers.get("Accept-Ranges", True)
-        if nonseekable == "bytes":
-            nonseekable = False
+    def parse(self, headers):
+        """Parse the metadata of the file from the headers."""
+        # keep the metadata in memory, so that getattr and open need no request
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.validator = self.get_validator(headers)
+        # a file of unknown size is served as empty, as getattr reports
+        self._size = int(headers.get("Content-Length", 0))
+        if self.last_modified:
+            self._mtime_ns = int(
+                parsedate_to_datetime(self.last_modified).timestamp() * 1e9
+            )
         else:
-            if nonseekable not in ["none", "false", "False", "0", "no", "No"]:
-                logging.warning("Unknown Accept-Ranges value: %s", nonseekable)
-            nonseekable = True
-        if nonseekable:
+            self._mtime_ns = 0
+
+        self._attr = pyfuse3.EntryAttributes()
+        self._attr.st_ino = self.inode
+        self._attr.st_mode = stat.S_IFREG | 0o444
+        self._attr.st_ctime_ns = self._mtime_ns
+        self._attr.st_atime_ns = self._mtime_ns
+        self._attr.st_mtime_ns = self._mtime_ns
+        self._attr.st_size = self._size
+        self._attr.st_gid = os.getgid()
+        self._attr.st_uid = os.getuid()
+
+        accept_ranges = headers.get("Accept-Ranges", "").lower()
+        self.nonseekable = accept_ranges != "bytes"
+        if self.nonseekable:
+            if accept_ranges not in _NONSEEKABLE_VALUES:
+                logging.warning("Unknown Accept-Ranges value: %r", accept_ranges)
             logging.error(f"File {self.name} is nonseekable")
-        return pyfuse3.FileInfo(fh=self.inode, keep_cache=True, nonseekable=nonseekable)
+
+    @staticmethod
+    def get_validator(headers):
+        # weak entity tags are not allowed in If-Range
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return headers.get("Last-Modified")
+
+    def changed(self, headers):
+        """Reload the metadata and drop the cached content of a changed file."""
+        logging.warning("File %s has changed on the server", self.name)
+        self.parse(headers)
+        self._version += 1
+        self._generation += 1
+        self.cache.invalidate(self.inode)
+        # the blocks still being downloaded are of the old content, so readers must
+        # not wait for them, and they are dropped when they arrive
+        self._inflight.clear()
+        trio.lowlevel.spawn_system_task(self._invalidate_inode)
+
+    async def _invalidate_inode(self):
+        # the kernel may wait for pending reads of the inode, which are served by
+        # this event loop, so do not block it
+        try:
+            await trio.to_thread.run_sync(pyfuse3.invalidate_inode, self.inode)
+        except OSError as e:
+            logging.warning("Failed to invalidate %s: %s", self.name, e)
+
+    async def getattr(self) -> pyfuse3.EntryAttributes:
+        return self._attr
+
+    async def getfileinfo(self) -> pyfuse3.FileInfo:
+        return pyfuse3.FileInfo(
+            fh=self.inode, keep_cache=True, nonseekable=self.nonseekable
+        )
 
     async def open(self):
         pass
 
+    def is_sequential(self, off) -> bool:
+        return any(
+            last_off + last_size == off for last_off, last_size in self._last_reads
+        )
+
     async def read(self, off, size) -> bytes:
-        return self.session.get(
-            self.url, headers={"Range": "bytes=%d-%d" % (off, off + size - 1)}
-        ).content
+        # reads at or past the end of the file need no request
+        if size <= 0 or off >= self._size:
+            return b""
+        size = min(size, self._size - off)
+
+        sequential = self.is_sequential(off)
+        self._last_reads.append((off, size))
+        if not sequential:
+            self._generation += 1
+
+        block_size = self.cache.block_size
+        first, last = off // block_size, (off + size - 1) // block_size
+        blocks = {}
+        waiting = {}
+        missing = []
+        for index in range(first, last + 1):
+            data = self.cache.get((self.inode, index))
+            if data is not None:
+                blocks[index] = data
+            elif index in self._inflight:
+                waiting[index] = self._inflight[index]
+            else:
+                missing.append(index)
+        # start all the downloads before waiting for any block; each block is
+        # served as soon as it has arrived, while the rest of its download
+        # continues in the background
+        pending = {}
+        for run_first, run_last in self.runs(missing):
+            pending.update(self.download(run_first, run_last))
+        for index, block in waiting.items():
+            data = await block.wait()
+            if data is None:
+                # the other download has failed or is outdated
+                pending.update(self.download(index, index))
+            else:
+                blocks[index] = data
+        for index, block in pending.items():
+            data = await block.wait()
+            if data is None and block.outdated:
+                # the file has changed during the download, so fetch the new content
+                data = await self.download(index, index)[index].wait()
+            if data is None:
+                raise pyfuse3.FUSEError(errno.EIO)
+            blocks[index] = data
+
+        if sequential:
+            self.prefetch(last + 1)
+        # copy only the requested part of each block, and only once
+        parts = []
+        for index in range(first, last + 1):
+            base = index * block_size
+            block = memoryview(blocks[index])
+            parts.append(block[max(off - base, 0) : off + size - base])
+            # a short block is the end of the file
+            if len(block) < block_size:
+                break
+        return b"".join(parts)
+
+    def download(self, first, last, prefetch=False) -> dict:
+        """Start downloading the blocks from first to last in the background.
+
+        Returns the pending blocks, which are resolved one by one as soon as
+        their data has arrived. The blocks of a prefetch are only cached if no
+        non-sequential read has happened in the meantime.
+        """
+        pending = {}
+        for index in range(first, last + 1):
+            pending[index] = PendingBlock()
+            self._inflight.setdefault(index, pending[index])
+        generation = self._generation if prefetch else None
+        trio.lowlevel.spawn_system_task(
+            self._download, first, last, pending, generation
+        )
+        return pending
+
+    async def _download(self, first, last, pending, generation):
+        # ranges larger than the parallel threshold are split into up to
+        # `workers` range requests, which are downloaded concurrently
+        count = last - first + 1
+        try:
+            if count * self.cache.block_size <= self.parallel_threshold:
+                await self._fetch(first, last, pending, generation)
+            else:
+                step = -(-count // self.workers)
+                async with trio.open_nursery() as nursery:
+                    for part_first in range(first, last + 1, step):
+                        part_last = min(part_first + step - 1, last)
+                        nursery.start_soon(
+                            self._fetch, part_first, part_last, pending, generation
+                        )
+        finally:
+            # wake up the readers of the blocks which have not arrived
+            for index, block in pending.items():
+                self.resolve(index, block, None, generation)
+
+    async def _fetch(self, first, last, pending, generation):
+        # a failed part must not cancel the other parts of the download
+        try:
+            await self.fetch(first, last, pending, generation)
+        except Exception as e:
+            logging.warning(
+                "Failed to download blocks %d-%d of %s: %s", first, last, self.name, e
+            )
+
+    async def fetch(self, first, last, pending, generation, revalidate=True):
+        """Download the blocks from first to last in one range request."""
+        version, validator = self._version, self.validator
+        block_size = self.cache.block_size
+        start, end = first * block_size, (last + 1) * block_size
+        end = min(end, self._size)
+        if start >= end:
+            # the file has shrunk past the blocks, so there is nothing to request
+            for index in range(first, last + 1):
+                self.resolve(index, pending[index], b"", generation, version)
+            return
+        headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+        if validator:
+            # if the file has changed, the server answers with the whole new file
+            headers["If-Range"] = validator
+        async with self.client.stream("GET", self.url, headers=headers) as resp:
+            if (
+                resp.status_code == 200
+                and validator
+                and self.get_validator(resp.headers) != validator
+            ):
+                if not revalidate:
+                    raise httpx.HTTPStatusError(
+                        "%s keeps changing on the server" % self.url,
+                        request=resp.request,
+                        response=resp,
+                    )
+                # concurrent downloads all see the change, but only the first one
+                # reloads the metadata
+                if version == self._version:
+                    self.changed(resp.headers)
+            else:
+                self.check(resp, start)
+                sizes = [
+                    max(min(block_size, end - block_start), 0)
+                    for block_start in range(start, (last + 1) * block_size, block_size)
+                ]
+                await self.receive(resp, first, sizes, pending, generation, version)
+                return
+        await self.fetch(first, last, pending, generation, revalidate=False)
+
+    def check(self, resp, start):
+        """Raise unless the response holds the content of the file from start on."""
+        if resp.status_code == 206:
+            content_range = resp.headers.get("Content-Range", "")
+            if content_range.startswith("bytes %d-" % start):
+                return
+        # a server ignoring the range answers with the whole file, which is only
+        # usable if the range starts at the beginning
+        elif resp.status_code == 200 and start == 0:
+            return
+        resp.raise_for_status()
+        raise httpx.HTTPStatusError(
+            "Unexpected response to a range request: %d %s"
+            % (resp.status_code, resp.headers.get("Content-Range", "")),
+            request=resp.request,
+            response=resp,
+        )
+
+    async def receive(self, resp, first, sizes, pending, generation, version):
+        # stream the response straight into preallocated blocks, instead of
+        # letting the client buffer the whole body and splitting it afterwards
+        blocks = [bytearray(size) for size in sizes]
+        index, n = 0, 0
+        async for chunk in resp.aiter_raw(chunk_size=256 * 1024):
+            chunk = memoryview(chunk)
+            while chunk and index < len(blocks):
+                size = min(len(chunk), len(blocks[index]) - n)
+                blocks[index][n : n + size] = chunk[:size]
+                chunk = chunk[size:]
+                n += size
+                if n == len(blocks[index]):
+                    block, data = pending[first + index], blocks[index]
+                    self.resolve(first + index, block, data, generation, version)
+                    index, n = index + 1, 0
+            if index == len(blocks):
+                return
+        # the response ended early, so the blocks which have not been filled are
+        # unusable, except those past the end of the file
+        for index in range(index, len(blocks)):
+            data = None if sizes[index] else blocks[index]
+            block = pending[first + index]
+            self.resolve(first + index, block, data, generation, version)
+
+    def resolve(self, index, block, data, generation, version=None):
+        """Cache the data of a pending block, and hand it to its readers."""
+        if block.done:
+            return
+        # blocks of the content from before a change are dropped
+        outdated = version is not None and version != self._version
+        if outdated:
+            data = None
+        # blocks of outdated prefetches are not cached
+        if data is not None and generation in (None, self._generation):
+            self.cache.put((self.inode, index), data)
+        if self._inflight.get(index) is block:
+            del self._inflight[index]
+        block.set(data, outdated)
+
+    def prefetch(self, first):
+        """Download the blocks following a sequential read in the background."""
+        block_size = self.cache.block_size
+        last = min(first + self.prefetch_blocks, -(-self._size // block_size)) - 1
+        missing = [
+            index
+            for index in range(first, last + 1)
+            if index not in self._inflight and (self.inode, index) not in self.cache
+        ]
+        # each run is one download, so that a window larger than the parallel
+        # threshold is split into concurrent range requests
+        for run_first, run_last in self.runs(missing):
+            self.download(run_first, run_last, prefetch=True)
+
+    @staticmethod
+    def runs(indices) -> list:
+        """Group the sorted block indices into runs of consecutive blocks."""
+        runs = []
+        for index in indices:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        return runs
 
 
 class tempofs(pyfuse3.Operations):
@@ -69,44 +427,60 @@ class tempofs(pyfuse3.Operations):
 
         # construct the file system from the config file
         with open(config_path, "r") as f:
-            config: dict = yaml.load(f, Loader=yaml.FullLoader)
+            config: dict = yaml.load(f, Loader=SafeLoader)
+        # one connection pool shared by all the files, so that files on the same
+        # host reuse the connections instead of paying a handshake each, and
+        # concurrent range requests are multiplexed over HTTP/2 where supported
+        self.client = httpx.AsyncClient(
+            follow_redirects=True,
+            # byte ranges are only meaningful for the content as it is stored
+            headers={"Accept-Encoding": "identity"},
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                retries=3,
+            ),
+        )
+        self.cache = BlockCache()
         self.files = []
         for name, url in config.items():
             inode = pyfuse3.ROOT_INODE + 1 + len(self.files)
-            self.files.append(webfile(inode, name, url))
+            self.files.append(webfile(inode, name, url, self.client, self.cache))
+        self.by_inode = {file.inode: file for file in self.files}
+        self.by_name = {file.name_bytes: file for file in self.files}
+
+        self._root_attr = pyfuse3.EntryAttributes()
+        self._root_attr.st_mode = stat.S_IFDIR | 0o755
+        self._root_attr.st_size = 0
+        self._root_attr.st_gid = os.getgid()
+        self._root_attr.st_uid = os.getuid()
+        self._root_attr.st_ino = pyfuse3.ROOT_INODE
+
+    async def probe(self):
+        # probe all the files concurrently, so that mounting takes one round-trip
+        async with trio.open_nursery() as nursery:
+            for file in self.files:
+                nursery.start_soon(file.probe)
 
     def find(self, inode):
-        for file in self.files:
-            if file.inode == inode:
-                return file
-        raise IndexError
+        return self.by_inode[inode]
 
     async def getattr(self, inode, ctx=None):
-        entry = pyfuse3.EntryAttributes()
+        # the attributes of all the inodes are precomputed, owner included
         if inode == pyfuse3.ROOT_INODE:
-            entry.st_mode = stat.S_IFDIR | 0o755
-            entry.st_size = 0
-            entry.st_gid = os.getgid()
-            entry.st_uid = os.getuid()
-            entry.st_ino = inode
-            return entry
-        else:
-            for file in self.files:
-                if file.inode == inode:
-                    entry = await file.getattr()
-                    entry.st_gid = os.getgid()
-                    entry.st_uid = os.getuid()
-                    entry.st_ino = inode
-                    return entry
-        raise pyfuse3.FUSEError(errno.ENOENT)
+            return self._root_attr
+        try:
+            return await self.find(inode).getattr()
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
 
     async def lookup(self, parent_inode, name, ctx=None):
         if parent_inode != pyfuse3.ROOT_INODE:
             raise pyfuse3.FUSEError(errno.ENOENT)
-        for file in self.files:
-            if file.name == name:
-                return file.getattr()
-        raise pyfuse3.FUSEError(errno.ENOENT)
+        try:
+            return self.by_name[name]._attr
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
 
     async def opendir(self, inode, ctx):
         if inode != pyfuse3.ROOT_INODE:
@@ -115,17 +489,10 @@ class tempofs(pyfuse3.Operations):
 
     async def readdir(self, fh, start_id, token):
         assert fh == pyfuse3.ROOT_INODE
-        try:
-            file = self.files[start_id]
-            pyfuse3.readdir_reply(
-                token,
-                bytes(file.name, encoding="ascii"),
-                await file.getattr(),
-                start_id + 1,
-            )
-            return
-        except IndexError:
-            raise pyfuse3.FUSEError(errno.ENOENT)
+        # the attributes are precomputed, so no request is awaited while listing
+        for next_id, file in enumerate(self.files[start_id:], start_id + 1):
+            if not pyfuse3.readdir_reply(token, file.name_bytes, file._attr, next_id):
+                break
 
     async def open(self, inode, flags, ctx) -> pyfuse3.FileInfo:
         if (
@@ -138,7 +505,7 @@ class tempofs(pyfuse3.Operations):
             raise pyfuse3.FUSEError(errno.EACCES)
         try:
             return await self.find(inode).getfileinfo()
-        except IndexError:
+        except KeyError:
             raise pyfuse3.FUSEError(errno.ENOENT)
 
     async def read(self, fh, off, size):
@@ -176,6 +543,18 @@ def parse_args():
     return parser.parse_args()
 
 
+async def serve(fs, mountpoint, fuse_options):
+    # the http client is bound to the event loop, so the files are probed and
+    # served within the same loop
+    async with fs.client:
+        await fs.probe()
+        pyfuse3.init(fs, str(mountpoint), fuse_options)
+        try:
+            await pyfuse3.main()
+        finally:
+            pyfuse3.close(unmount=True)
+
+
 def main():
     options = parse_args()
     init_logging(options.debug)
@@ -186,11 +565,7 @@ def main():
 
     if options.debug:
         fuse_options.add("debug")
-    pyfuse3.init(testfs, str(options.mountpoint), fuse_options)
-    try:
-        trio.run(pyfuse3.main)
-    finally:
-        pyfuse3.close(unmount=True)
+    trio.run(serve, testfs, options.mountpoint, fuse_options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,400 @@
+import errno
+import os
+import stat
+
+import httpx
+import pytest
+import trio
+import trio.testing
+
+pyfuse3 = pytest.importorskip("pyfuse3")
+
+import tempofs
+
+URL = "http://example.com/file"
+BLOCK_SIZE = 1024
+
+
+class SlowStream(httpx.AsyncByteStream):
+    """A body whose second half is only sent once the server is released."""
+
+    def __init__(self, body, release):
+        self.body = body
+        self.release = release
+
+    async def __aiter__(self):
+        half = len(self.body) // 2
+        yield self.body[:half]
+        await self.release.wait()
+        yield self.body[half:]
+
+
+class Server:
+    """A server of a single file, which answers range requests like a web server."""
+
+    def __init__(self, content, etag='"v1"'):
+        self.content = content
+        self.etag = etag
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        # for misbehaving servers
+        self.status = None
+        self.ignore_range = False
+        self.truncate = False
+        self.release = None
+
+    def change(self, content, etag):
+        self.content = content
+        self.etag = etag
+
+    async def handler(self, request):
+        self.requests.append(request)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        # let concurrent requests reach the server before any is answered
+        await trio.sleep(0)
+        self.active -= 1
+        return self.answer(request)
+
+    def answer(self, request):
+        headers = {"ETag": self.etag, "Accept-Ranges": "bytes"}
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(self.content))
+            return httpx.Response(200, headers=headers)
+        if self.status:
+            return httpx.Response(self.status, content=b"<html>busy</html>")
+        if_range = request.headers.get("If-Range")
+        if self.ignore_range or if_range is not None and if_range != self.etag:
+            return self.respond(200, headers, self.content)
+        start, end = map(int, request.headers["Range"][len("bytes=") :].split("-"))
+        end = min(end, len(self.content) - 1)
+        body = self.content[start : end + 1]
+        if self.truncate:
+            body = body[: len(body) // 2]
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(self.content))
+        return self.respond(206, headers, body)
+
+    def respond(self, status_code, headers, body):
+        # a streamed body, like the responses of a real server
+        headers["Content-Length"] = str(len(body))
+        if self.release:
+            stream = SlowStream(body, self.release)
+        else:
+            stream = httpx.ByteStream(body)
+        return httpx.Response(status_code, headers=headers, stream=stream)
+
+    @property
+    def gets(self):
+        return [request for request in self.requests if request.method == "GET"]
+
+
+@pytest.fixture
+def server():
+    return Server(os.urandom(10 * BLOCK_SIZE))
+
+
+@pytest.fixture(autouse=True)
+def invalidated(monkeypatch):
+    inodes = []
+    monkeypatch.setattr(pyfuse3, "invalidate_inode", inodes.append, raising=False)
+    return inodes
+
+
+def run(server, test, **kwargs):
+    """Run the test with a probed file backed by the server."""
+
+    async def main():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(server.handler))
+        cache = tempofs.BlockCache(block_size=BLOCK_SIZE)
+        file = tempofs.webfile(2, "file", URL, client, cache, **kwargs)
+        async with client:
+            await file.probe()
+            await test(file)
+
+    trio.run(main)
+
+
+def test_read_is_served_from_cache(server):
+    async def test(file):
+        assert await file.read(100, 2000) == server.content[100:2100]
+        assert await file.read(1500, 100) == server.content[1500:1600]
+
+    run(server, test)
+    assert len(server.gets) == 1
+
+
+def test_read_past_eof_sends_no_request(server):
+    async def test(file):
+        assert await file.read(len(server.content), 100) == b""
+        assert await file.read(len(server.content) - 10, 100) == server.content[-10:]
+
+    run(server, test)
+    assert len(server.gets) == 1
+
+
+def test_file_of_unknown_size_is_empty(server):
+    async def test(file):
+        file.parse({"ETag": server.etag})
+        assert (await file.getattr()).st_size == 0
+        assert await file.read(0, 100) == b""
+
+    run(server, test)
+    assert not server.gets
+
+
+def test_error_response_is_not_cached(server):
+    server.status = 503
+
+    async def test(file):
+        with pytest.raises(pyfuse3.FUSEError) as e:
+            await file.read(0, 100)
+        assert e.value.errno == errno.EIO
+        assert not file.cache.blocks
+
+        server.status = None
+        assert await file.read(0, 100) == server.content[:100]
+
+    run(server, test)
+
+
+def test_ignored_range_is_only_used_from_the_start(server):
+    server.ignore_range = True
+
+    async def test(file):
+        assert await file.read(0, 100) == server.content[:100]
+        with pytest.raises(pyfuse3.FUSEError):
+            await file.read(3 * BLOCK_SIZE, 100)
+        assert (file.inode, 3) not in file.cache
+
+    run(server, test)
+
+
+def test_short_response_is_not_cached(server):
+    server.truncate = True
+
+    async def test(file):
+        with pytest.raises(pyfuse3.FUSEError) as e:
+            await file.read(BLOCK_SIZE - 10, BLOCK_SIZE + 20)
+        assert e.value.errno == errno.EIO
+        # only the first half of the range has arrived
+        assert file.cache.get((file.inode, 0)) == server.content[:BLOCK_SIZE]
+        assert (file.inode, 1) not in file.cache
+
+    run(server, test)
+
+
+def test_changed_file_is_reloaded(server, invalidated):
+    new_content = os.urandom(12 * BLOCK_SIZE)
+
+    async def test(file):
+        assert await file.read(0, 100) == server.content[:100]
+        server.change(new_content, '"v2"')
+        results = {}
+
+        async def read(index):
+            results[index] = await file.read(index * BLOCK_SIZE, BLOCK_SIZE)
+
+        async with trio.open_nursery() as nursery:
+            for index in (1, 3, 5):
+                nursery.start_soon(read, index)
+        for index, data in results.items():
+            assert data == new_content[index * BLOCK_SIZE : (index + 1) * BLOCK_SIZE]
+        assert file.validator == '"v2"'
+        assert (await file.getattr()).st_size == len(new_content)
+        assert (file.inode, 0) not in file.cache
+        await trio.testing.wait_all_tasks_blocked()
+
+    run(server, test)
+    assert invalidated == [2]
+
+
+def test_read_past_eof_of_shrunk_file_sends_no_range(server):
+    new_content = os.urandom(5 * BLOCK_SIZE)
+
+    async def test(file):
+        server.change(new_content, '"v2"')
+        assert await file.read(7 * BLOCK_SIZE, 100) == b""
+        assert (await file.getattr()).st_size == len(new_content)
+
+    run(server, test)
+    # the retry after the change is not sent, as the range is past the new end
+    assert [request.headers["Range"] for request in server.gets] == ["bytes=7168-8191"]
+
+
+def test_read_survives_a_change_while_streaming(server):
+    new_content = os.urandom(10 * BLOCK_SIZE)
+
+    async def test(file):
+        server.release = trio.Event()
+        results = {}
+
+        async def read(off):
+            results[off] = await file.read(off, 100)
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(read, 0)
+            await trio.testing.wait_all_tasks_blocked()
+            # the first read is still streaming the old content
+            server.change(new_content, '"v2"')
+            nursery.start_soon(read, 3 * BLOCK_SIZE)
+            await trio.testing.wait_all_tasks_blocked()
+            server.release.set()
+        assert results == {
+            0: new_content[:100],
+            3 * BLOCK_SIZE: new_content[3 * BLOCK_SIZE : 3 * BLOCK_SIZE + 100],
+        }
+        assert file.cache.get((file.inode, 0)) == new_content[:BLOCK_SIZE]
+
+    run(server, test)
+
+
+def test_concurrent_reads_are_cached(server):
+    async def test(file):
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(file.read, 0, 100)
+            nursery.start_soon(file.read, 3 * BLOCK_SIZE, 100)
+        assert (file.inode, 0) in file.cache
+        assert (file.inode, 3) in file.cache
+
+    run(server, test)
+
+
+def test_read_waits_for_prefetch_and_downloads_missing_blocks(server):
+    async def test(file):
+        file.download(1, 1, prefetch=True)
+        data = await file.read(BLOCK_SIZE, 2 * BLOCK_SIZE)
+        assert data == server.content[BLOCK_SIZE : 3 * BLOCK_SIZE]
+
+    run(server, test)
+    assert sorted(request.headers["Range"] for request in server.gets) == [
+        "bytes=1024-2047",
+        "bytes=2048-3071",
+    ]
+    # the missing block is requested while the prefetch is in flight
+    assert server.max_active == 2
+
+
+def test_read_skips_cached_blocks_between_missing_ones(server):
+    async def test(file):
+        await file.read(BLOCK_SIZE, 100)
+        data = await file.read(0, 3 * BLOCK_SIZE)
+        assert data == server.content[: 3 * BLOCK_SIZE]
+
+    run(server, test)
+    assert sorted(request.headers["Range"] for request in server.gets) == [
+        "bytes=0-1023",
+        "bytes=1024-2047",
+        "bytes=2048-3071",
+    ]
+
+
+def test_sequential_reads_prefetch(server):
+    async def test(file):
+        await file.read(0, 512)
+        await file.read(512, 512)
+        await trio.testing.wait_all_tasks_blocked()
+        for index in range(1, 5):
+            assert (file.inode, index) in file.cache
+        # the prefetch window is split into parallel range requests
+        assert len(server.gets) == 1 + 4
+        assert await file.read(1024, 4096) == server.content[1024:5120]
+        assert len(server.gets) == 1 + 4
+        await trio.testing.wait_all_tasks_blocked()
+
+    run(server, test, parallel_threshold=2 * BLOCK_SIZE)
+
+
+def test_outdated_prefetch_is_not_cached(server):
+    async def test(file):
+        file.download(5, 5, prefetch=True)
+        # a random read makes the prefetch outdated before it has arrived
+        await file.read(8 * BLOCK_SIZE, 100)
+        await trio.testing.wait_all_tasks_blocked()
+        assert (file.inode, 5) not in file.cache
+        assert (file.inode, 8) in file.cache
+
+    run(server, test)
+
+
+@pytest.fixture
+def fs(tmp_path, server):
+    config = tmp_path / "config.yaml"
+    config.write_text("a.txt: %s\nünï.bin: %s\n" % (URL, URL), encoding="utf-8")
+    fs = tempofs.tempofs(config)
+    for file in fs.files:
+        # the metadata a probe would have found
+        file.parse({"ETag": server.etag, "Content-Length": str(len(server.content))})
+    return fs
+
+
+def test_lookup(fs):
+    async def test():
+        attr = await fs.lookup(pyfuse3.ROOT_INODE, b"a.txt")
+        assert attr is fs.files[0]._attr
+        attr = await fs.lookup(pyfuse3.ROOT_INODE, os.fsencode("ünï.bin"))
+        assert attr is fs.files[1]._attr
+        for parent_inode, name in [
+            (pyfuse3.ROOT_INODE, b"missing"),
+            (pyfuse3.ROOT_INODE, "a.txt"),
+            (fs.files[0].inode, b"a.txt"),
+        ]:
+            with pytest.raises(pyfuse3.FUSEError) as e:
+                await fs.lookup(parent_inode, name)
+            assert e.value.errno == errno.ENOENT
+
+    trio.run(test)
+
+
+def test_readdir(fs, monkeypatch):
+    entries = []
+
+    def readdir_reply(token, name, attr, next_id):
+        # the buffer of the kernel holds a single entry
+        if len(entries) == token:
+            return False
+        entries.append((name, attr, next_id))
+        return True
+
+    monkeypatch.setattr(pyfuse3, "readdir_reply", readdir_reply, raising=False)
+
+    async def test():
+        await fs.readdir(pyfuse3.ROOT_INODE, 0, 1)
+        await fs.readdir(pyfuse3.ROOT_INODE, entries[-1][2], 2)
+        # the end of the listing is not an error
+        await fs.readdir(pyfuse3.ROOT_INODE, entries[-1][2], 3)
+
+    trio.run(test)
+    assert entries == [
+        (b"a.txt", fs.files[0]._attr, 1),
+        (os.fsencode("ünï.bin"), fs.files[1]._attr, 2),
+    ]
+
+
+def test_getattr(fs):
+    async def test():
+        attr = await fs.getattr(pyfuse3.ROOT_INODE)
+        assert stat.S_ISDIR(attr.st_mode)
+        attr = await fs.getattr(fs.files[1].inode)
+        assert stat.S_ISREG(attr.st_mode)
+        assert attr.st_size == 10 * BLOCK_SIZE
+        with pytest.raises(pyfuse3.FUSEError) as e:
+            await fs.getattr(100)
+        assert e.value.errno == errno.ENOENT
+
+    trio.run(test)
+
+
+def test_open(fs):
+    async def test():
+        info = await fs.open(fs.files[0].inode, os.O_RDONLY, None)
+        assert info.fh == fs.files[0].inode
+        for flags in (os.O_WRONLY, os.O_RDWR, os.O_RDONLY | os.O_TRUNC):
+            with pytest.raises(pyfuse3.FUSEError) as e:
+                await fs.open(fs.files[0].inode, flags, None)
+            assert e.value.errno == errno.EACCES
+        with pytest.raises(pyfuse3.FUSEError) as e:
+            await fs.open(100, os.O_RDONLY, None)
+        assert e.value.errno == errno.ENOENT
+
+    trio.run(test)